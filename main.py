@@ -1,6 +1,7 @@
 import nibabel as nib
 import cv2 as cv
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 ##############################################################################
 #   - Lung Segmentation on a CT scan
@@ -25,6 +26,22 @@ class colors:
     non_body = (60, 60, 60)
     lungs = (240, 160, 160)
 
+# Labels are used instead of colors while the image is being
+# processed, so every pixel is just one byte instead of three
+class labels:
+    air = 0
+    tissue = 1
+    non_body = 2
+    lungs = 3
+
+# Colors of the labels as opencv's lookup table (LUT) with 256 entries,
+# color of each label is at the index of that label
+palette = np.zeros((256, 1, 3), np.uint8)
+palette[labels.air] = colors.air
+palette[labels.tissue] = colors.tissue
+palette[labels.non_body] = colors.non_body
+palette[labels.lungs] = colors.lungs
+
 # THRESHOLD
 # controls from which value is pixel considered tissue and from which air
 # if pixel is under the threshold it will be considered air and above as tissue
@@ -40,15 +57,17 @@ threshold = 40
 # jump size needs TO BE OVER 10 and also UNDER 25!
 jump_size = 15
 
-def lungDetection(file_path):
+def lungDetection(file_path, with_original=True):
     """
     This function takes path of a chest CT file (in .nii.gz or .nii)
     And then from it, extracts lungs and calculates there area.
+    File can be a single slice or a whole volume with slices on the last axis,
+    each slice of a volume is normalized and segmented on its own.
 
     The function returns 3 values:
-        - Original image
+        - Original image (None if with_original is False)
         - Colored image on which can be seen lungs
-        - Area of the lungs in mm2
+        - Area of the lungs in mm2 (for a volume, float32 array with area of each slice)
     """
 
     # Loads the CT scan file using nibabel librarie
@@ -57,8 +76,15 @@ def lungDetection(file_path):
     file: nib.DataobjImage = nib.load(file_path) 
     
     # CT scan file are composed of headers and the actual images
-    # so to extract image data get_fdata func is used
-    raw_image = file.get_fdata() 
+    # so to extract image data dataobj is used. Unlike get_fdata it keeps
+    # the type that is stored in the file (usually int16) instead of
+    # making a float64 copy of the whole image that is 4 times bigger
+    raw_image = np.asanyarray(file.dataobj)
+
+    # Single slice is often saved as a volume with only one slice (H x W x 1),
+    # that is still just a single slice so the last axis is removed
+    if raw_image.ndim == 3 and raw_image.shape[2] == 1:
+        raw_image = raw_image[:, :, 0]
 
     # In order for image to be turned into opencv Mat object it
     # first needs to be normalized. This is done by subtracting 
@@ -68,116 +94,158 @@ def lungDetection(file_path):
     # That makes it so that all of the pixels are between 0 and 1 of value, 
     # then they are multiplied by 255 to represent intensity of a pixel using a single byte
     # At the end values are converted to unsigned 8-bit intigers
-    normalized = (raw_image - np.min(raw_image)) / (np.max(raw_image) - np.min(raw_image))
+    # Minimum and maximum are found only once, and dividing and multiplying
+    # is done in place, so only one temporary copy of the image is made instead of three.
+    # Its divided and then multiplied (not multiplied by 255/(max-min)) so the
+    # result is exactly the same as before, otherwise few pixels can be one level off
+    # Minimum and maximum are found for each slice (first two axes), so slices of a volume
+    # are normalized the same as if they were each in its own file, threshold is tuned for that.
+    # They are taken as floats so int16 can't overflow
+    minimum = raw_image.min(axis=(0, 1), keepdims=True).astype(np.float64)
+    maximum = raw_image.max(axis=(0, 1), keepdims=True).astype(np.float64)
+
+    # If whole slice is the same color (blank slice) there is nothing to divide by,
+    # after subtracting the minimum all pixels are 0 so they just stay 0
+    value_range = maximum - minimum
+    value_range[value_range == 0] = 1
+
+    normalized = np.subtract(raw_image, minimum, dtype=np.float64)
+    np.divide(normalized, value_range, out=normalized)
     normalized *= 255
     normalized = normalized.astype(np.uint8)
 
-    # Now that normalized image data is converted to opencv's Mat object
-    image = cv.cvtColor(normalized, cv.COLOR_GRAY2BGR)
-    original = image.copy() # Copy the image now so we can return unmodified version too
-
-    # Images dimensions are loaded
-    height, width, _ = image.shape
-
-    # This variable will be used to store coordinates of the last
-    # black pixel that has been seen in the current row
-    last = (0, 0) # (x, y)
-
-    # Using this for loop, program is going row by row, pixel by pixel
-    for y in range(height):
-        for x in range(width):
-            # If color of the pixel is less then the threshold color
-            if all(image[y, x] < threshold):
-                # Set pixel to air color
-                image[y, x] = colors.air
-
-                # If its the same row as last air pixel and
-                # If difference between last black pixel and current black pixel is
-                # less then jump_size then it should color be colored too
-                if (y == last[1]) and (x - last[0] < jump_size):
-                    
-                    # For each pixel that was in the gap set air color
-                    for i in range(1, x-last[0]):
-                        image[y, last[0]+i] = colors.air
-                
-                # Then it sets the last to current pixel coordinates
-                last = (x, y)
-            else: 
-                # If image was above the threshold then make it tissue color
-                image[y, x] = colors.tissue
-    
-    # Now both air in the lungs and air outside of the body are colors the same
-    # and other organs (like hart and ribs) are tissue color
+    # Images dimensions are loaded, single slice is the same as a volume with one slice
+    is_volume = normalized.ndim == 3
+    height, width, depth = normalized.shape if is_volume else (*normalized.shape, 1)
+
+    # Slices of a volume are put one under the other and the whole volume
+    # is segmented as one tall image, without going slice by slice.
+    # Gap filling goes row by row so rows of different slices don't affect each other.
+    # nibabel gives the image in Fortran order (column by column), but opencv
+    # needs it row by row (C order) and otherwise it would make a copy in every function.
+    # Fortran order slice is the same as C order slice that is transposed,
+    # so each slice is just transposed into its place using opencv's transpose
+    # which is a lot faster then numpy making the copy
+    slices = np.moveaxis(normalized, 2, 0) if is_volume else normalized[np.newaxis]
+    if normalized.flags['F_CONTIGUOUS']:
+        stacked = np.empty((depth, height, width), np.uint8)
+        for k in range(depth):
+            cv.transpose(slices[k].T, stacked[k])
+    else:
+        stacked = np.ascontiguousarray(slices)
+    normalized = stacked.reshape(depth * height, width)
+
+    # Instead of going pixel by pixel, whole normalized image is compared
+    # with the threshold at once using opencv's threshold. That gives a mask
+    # in which 1 means that the pixel is air (under the threshold) and 0 that its tissue.
+    # THRESH_BINARY_INV sets to 0 everything above threshold-1, so everything that is not under threshold
+    _, air_mask = cv.threshold(normalized, threshold - 1, 1, cv.THRESH_BINARY_INV)
+
+    # Small gaps between air pixels (blood vessels, patients bed...) should be air too.
+    # If two air pixels are in the same row and difference between them is less
+    # then jump_size, everything between them is air. That is exactly what
+    # morphological closing with a horizontal line of jump_size-1 pixels does,
+    # so it's done using opencv's dilate and erode for the whole image at once.
+    # Mask is padded with tissue on left and right so the gaps that are touching
+    # the edge of the image are not filled, since there is no air pixel before them.
+    # Dilate and erode are called separately with mirrored anchors, because
+    # morphologyEx doesn't mirror the kernel and with even kernel size
+    # that would shift the result by one pixel
+    line = np.ones((1, jump_size - 1), np.uint8)
+    padded = cv.copyMakeBorder(air_mask, 0, 0, jump_size, jump_size, cv.BORDER_CONSTANT, value=0)
+    closed = cv.dilate(padded, line, anchor=(0, 0))
+    closed = cv.erode(closed, line, anchor=(jump_size - 2, 0))
+    air_mask = closed[:, jump_size:-jump_size].astype(bool)
+
+    # Now both air in the lungs and air outside of the body are the same
+    # and other organs (like hart and ribs) are tissue
 
     # Display the current image (if you want to current results)
-    # cv.imshow('Air & Tissue', image)
-    
-    # This goes over each pixel again to distinguishes the air from outside
-    # of the body from the air that is inside of the lungs
-    for y in range(height):
-
-        # This stores all of the edges (points on which color changes)
-        # If this is a image row (- is air and = is tissue):
-        # -------======---------====--------
-        # This would be edges: (1, 2, 3, 4)
-        # -------1=====2--------3===4-------
-        # Its places where color changes
-        edges = []
-
-        # This goes over each pixel in the row
-        for x in range(width):
-            # If current pixels color is not equal the the previous
-            # pixels color then it adds the current coordinates to edges
-            if(x != 0 and not all(image[y, x] == image[y, x-1])):
-                edges.append((x, y))
-        
-        # There was a small error that few pixels near the end of the row
-        # would make a bug so if pixel of the last edge are tissue color
-        # then just remove that edge, its a FAKE EDGE
-        if len(edges) > 0 and all(image[y, edges[-1][0]] == colors.tissue):
-            edges.pop()
-        
-
-        fill = True
-
-        # Iterate over each pixel of the row again
-        # It will be filling everything before the first edge and everything after the last edge
-        for x in range(width):
-            if len(edges) > 0:
-                # If first edge is passed turn the fill Off
-                if x == edges[0][0]: fill = False
-                
-                # If the last edge is passed turn the fill on again
-                if x == edges[-1][0]: fill = True
-            
-            # If fill is true make the pixel non body color
-            if fill: image[y, x] = colors.non_body
-    
-    area = 0
-    # It goes over each pixel AGAIN and if its air color 
-    # then that means that that's air inside the lungs
-    # since the one that was outside was colored differently
-    # in the last for loop
-    for y in range(height):
-        for x in range(width):
-            # Checks if pixel is air color
-            if all(image[y, x] == colors.air):
-                # Add that pixel to lungs area
-                area += 1
-                # Color it into lungs color
-                image[y, x] = colors.lungs
+    # cv.imshow('Air & Tissue', air_mask.view(np.uint8) * 255)
+
+    # Next step is to distinguishes the air from outside
+    # of the body from the air that is inside of the lungs.
+    # Air outside of the body is all connected and it touches the edge of the image,
+    # while the air in the lungs is closed in by tissue. So every slice gets a frame
+    # of air one pixel wide around it, that connects all of the air from outside
+    # into one area, and that area is flood filled starting from the corner.
+    # Frames are also keeping the air of one slice from touching the next slice
+    framed = np.pad(air_mask.reshape(depth, height, width), ((0, 0), (1, 1), (1, 1)), constant_values=True)
+    framed = framed.reshape(depth * (height + 2), width + 2).astype(np.uint8)
+    cv.floodFill(framed, None, (0, 0), labels.non_body, flags=4)
+
+    # Everything that was filled is outside of the body
+    non_body_mask = framed == labels.non_body
+    non_body_mask = non_body_mask.reshape(depth, height + 2, width + 2)[:, 1:-1, 1:-1].reshape(depth * height, width)
+
+    # Air that is left, since the one that was outside is
+    # now non body, is the air inside of the lungs
+    lung_mask = air_mask & ~non_body_mask
+
+    # Area in pixels is just the number of True pixels in the mask (of each slice),
+    # count_nonzero counts them directly without first turning them into integers like sum does.
+    # It only does that when it counts the whole array (with axis it just calls sum),
+    # so for a volume its called once for each slice instead.
+    # Counts of a volume are float32, same as the zoom levels, so areas of a volume
+    # come out the same type as the area of a single slice (int times float32 zoom)
+    if is_volume:
+        area = np.array([np.count_nonzero(slice_mask) for slice_mask in lung_mask.reshape(depth, -1)], np.float32)
+    else:
+        area = int(np.count_nonzero(lung_mask))
+
+    # Every pixel gets its label in one go, a single byte per pixel. Non body pixels
+    # are labels.non_body, lungs are labels.lungs and everything else is labels.tissue
+    label = np.where(non_body_mask, np.uint8(labels.non_body),
+                     np.where(lung_mask, np.uint8(labels.lungs), np.uint8(labels.tissue)))
+
+    # The segmented image is made in one go, every pixel gets the color of its label.
+    # Labels are copied into all 3 channels and then opencv's LUT replaces each one
+    # with its color, that is a lot faster then indexing the palette with numpy
+    image = cv.LUT(cv.cvtColor(label, cv.COLOR_GRAY2BGR), palette)
+
+    # The normalized image is converted to opencv's BGR Mat object only now,
+    # at the end, so that unmodified version can be returned too.
+    # If its not needed (only area is), this is skipped
+    original = cv.cvtColor(normalized, cv.COLOR_GRAY2BGR) if with_original else None
 
     # Now area in in pixels and needs to be converted to mm2
     voxel_dimensions = file.header.get_zooms() # This loads the zoom levels from the header
     voxel_area = voxel_dimensions[0] * voxel_dimensions[1] # The its area its calculated
     area = area * voxel_area # Then real are ration is multiplied by pixel area
 
+    # Slices of a volume are put back on the last axis, same as in the file
+    if is_volume:
+        if with_original:
+            original = np.moveaxis(original.reshape(depth, height, width, 3), 0, 2)
+        image = np.moveaxis(image.reshape(depth, height, width, 3), 0, 2)
+
     return original, image, area
 
 
+def lungDetectionBatch(file_paths, with_original=True, workers=None):
+    """
+    This function does lungDetection for each of the given CT files,
+    files are spread over a pool of worker threads that process them in parallel.
+    workers sets how many threads are in the pool (by default its based on the number of CPU cores).
+
+    The function returns a list with 3 values (same as lungDetection)
+    for each of the files, in the same order as the files were given.
+    """
+
+    # Threads are enough since almost all of the time is spent in nibabel, numpy and opencv
+    # and they all release the GIL while working, so files really are processed in parallel.
+    # Processes would need to copy all of the images back to this process
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda file_path: lungDetection(file_path, with_original), file_paths))
+
+
 
 original, lungs, area = lungDetection("./src/slice016.nii.gz")
 cv.imshow('Original CT', original)
 cv.imshow('Segmented CT', lungs)
 print("Lung area:", area)
-cv.waitKey(0)
\ No newline at end of file
+cv.waitKey(0)
+
+# For many files at once, when only the areas are needed:
+# results = lungDetectionBatch(["./src/slice001.nii.gz", "./src/slice002.nii.gz"], with_original=False)
+# areas = [area for _, _, area in results]
\ No newline at end of file